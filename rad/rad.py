@@ -9,18 +9,24 @@ Much of the algorithms in this module are from the works of Liu et al.
 """
 
 import os
-import s3fs
+import sys
 import pickle
 import base64
 import logging
+import pyarrow
+import threading
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 from io import BytesIO
-from pyarrow import parquet
+from pyarrow import dataset, parquet
 from scipy.stats import norm
+from contextlib import contextmanager
 from collections import namedtuple
+from pyarrow.fs import FileType, S3FileSystem
+from urllib.parse import urlparse
+from botocore.session import Session
 
 
 __version__ = "0.9.6"
@@ -38,6 +44,11 @@ logging.basicConfig(format="%(asctime)s | "+\
                            "%(message)s",
                     level=logging.INFO)
 
+# Arrow thread-pools are process-wide; concurrent `fetch_s3` calls share them
+_pools_lock = threading.Lock()
+_pools_users = 0
+_pools_sizes = None
+
 
 def c(n):
     """
@@ -79,20 +90,56 @@ def s(x, n):
     return 2.0 ** (-x / c(n))
 
 
+@contextmanager
+def _thread_pools(io_threads, cpu_threads=None):
+    """
+    Resize the process-wide Arrow I/O and, if given, CPU thread-pools for the
+    duration of a scan. While other scans are running the pools are only ever
+    grown, and their prior sizes are restored once the last scan finishes.
+    """
+    global _pools_users, _pools_sizes
+    with _pools_lock:
+        if not _pools_users:
+            _pools_sizes = pyarrow.io_thread_count(), pyarrow.cpu_count()
+        else:
+            io_threads = max(io_threads, pyarrow.io_thread_count())
+            if cpu_threads:
+                cpu_threads = max(cpu_threads, pyarrow.cpu_count())
+        pyarrow.set_io_thread_count(io_threads)
+        if cpu_threads:
+            pyarrow.set_cpu_count(cpu_threads)
+        _pools_users += 1
+    try:
+        yield
+    finally:
+        with _pools_lock:
+            _pools_users -= 1
+            if not _pools_users:
+                pyarrow.set_io_thread_count(_pools_sizes[0])
+                pyarrow.set_cpu_count(_pools_sizes[1])
+
+
 def fetch_s3(bucket, profile_name=None, folder=None, date=None,
-             endpoint=None, workers=None):
+             endpoint=None, workers=None, columns=None, filters=None):
     """
     Queries data collected from Insights that is saved in S3. It is presumed
     `profile_name` (your ~/.aws/credentials name) exhibits credentials to
     facilitate such an access.
+    To limit how much data is fetched, `columns` restricts which columns are
+    read, and `filters` skips row-groups whose statistics cannot match. The
+    latter is in disjunctive normal form, i.e. [[("column", "=", value)]].
 
     Args:
          endpoint (str): S3 endpoint.
          profile_name (str): AWS credentials; found in ~/.aws/credentials
          bucket (str): S3 bucket name.
-         folder (str): folder name; contains many parquet files
+         folder (str): folder name; contains many parquet files, or a single
+            `.parquet` file whose prefix is not listed.
          date (str): S3 prefix; is that which is prepended to `bucket`.
-         workers (int): maximum number of worker threads.
+         workers (int): maximum number of worker threads; Arrow thread-pools
+            are process-wide, so overlapping calls share the largest.
+         columns (list): columns to read; if not set, all columns are read.
+         filters (list): row filters; predicates in disjunctive normal form.
     """
     if not profile_name:
         profile_name = "default"
@@ -100,19 +147,65 @@ def fetch_s3(bucket, profile_name=None, folder=None, date=None,
     if not endpoint:
         endpoint = "https://s3.upshift.redhat.com"
 
-    if not date:
-        date = ""
-
-    if not folder:
-        folder = ""
-
-    fs = s3fs.S3FileSystem(profile_name=profile_name,
-                           client_kwargs={"endpoint_url": endpoint})
-
-    # concatenate the bucket and all subsequent variables to give a full path
-    path = os.path.join(bucket, date, folder)
-    obj = parquet.ParquetDataset(path, fs, metadata_nthreads=workers)
-    frame = obj.read_pandas().to_pandas()
+    # resolve credentials for the profile, i.e. those in ~/.aws/credentials
+    session = Session(profile=profile_name)
+    credentials = session.get_credentials()
+    if credentials is None:
+        raise ValueError("No credentials found for `{}`".format(profile_name))
+    credentials = credentials.get_frozen_credentials()
+
+    # S3 is read natively by Arrow (C++) rather than calling back into python
+    url = urlparse(endpoint)
+    fs = S3FileSystem(access_key=credentials.access_key,
+                      secret_key=credentials.secret_key,
+                      session_token=credentials.token,
+                      region=session.get_config_variable("region"),
+                      endpoint_override=url.netloc or url.path,
+                      scheme=url.scheme or "https")
+
+    # concatenate the bucket and all subsequent variables to give a full path;
+    # S3 keys are always "/" delimited and empty parts add no trailing "/"
+    parts = (bucket, date, folder)
+    path = "/".join(part.strip("/") for part in parts if part)
+
+    # a single file, given as a list, is read without listing its S3 prefix;
+    # one HEAD request tells it apart from a Spark-style ".parquet" folder.
+    # Its key is not parsed for partitions, as is the case for a folder
+    partitioning = "hive"
+    if path.endswith(".parquet"):
+        if fs.get_file_info(path).type == FileType.File:
+            path, partitioning = [path], None
+
+    if filters is not None:
+        filters = parquet.filters_to_expression(filters)
+
+    # many concurrent range requests are issued by the Arrow I/O thread-pool,
+    # while decoding and conversion run on the Arrow CPU thread-pool
+    io_threads = workers or (os.cpu_count() or 1) * 4
+    with _thread_pools(io_threads, cpu_threads=workers):
+        # pre-buffering coalesces the column chunks of a row-group into few GETs
+        options = dataset.ParquetFragmentScanOptions(pre_buffer=True)
+        obj = dataset.dataset(path,
+                              filesystem=fs,
+                              format=dataset.ParquetFileFormat(
+                                  default_fragment_scan_options=options),
+                              partitioning=partitioning)
+
+        # unlike `read_pandas`, a projection drops the stored pandas index
+        if columns is not None:
+            metadata = obj.schema.pandas_metadata or {}
+            index = [name for name in metadata.get("index_columns", [])
+                     if isinstance(name, str) and name not in columns]
+            columns = list(columns) + index
+
+        table = obj.to_table(columns=columns,
+                             filter=filters,
+                             use_threads=True,
+                             fragment_readahead=4,
+                             batch_readahead=16)
+        frame = table.to_pandas(use_threads=True,
+                                split_blocks=True,
+                                self_destruct=True)
     return frame
 
 
@@ -144,8 +237,25 @@ def inventory_data_to_pandas(dic, target_features=None):
     else:
         raise TypeError("`dic` must an array or dict with `results` key.")
 
-    # list of dictionary items for each and every row
-    rows = []
+    # define some very high-level system facts
+    if not target_features:
+        target_features = ["system_properties.hostnames",
+                           "system_properties.memory_in_gb",
+                           "infrastructure.type",
+                           "infrastructure.vendor",
+                           "infrastructure.ipv4_addresses",
+                           "bios.vendor",
+                           "bios.version",
+                           "bios.release_date",
+                           "os.release",
+                           "os.kernel_release",
+                           "os.arch",
+                           "os.kernel_modules",
+                           "configuration.services"
+                           ]
+
+    # one entry per system fact; systems lacking data yield no entries
+    ids, displays, cols, values = [], [], [], []
 
     # iterate over all records; all data resides under the `results` key
     for record in data:
@@ -157,111 +267,108 @@ def inventory_data_to_pandas(dic, target_features=None):
             raise IOError("JSON must contain `account` key under `results`")
 
         # get some preliminary data; `id` is unique, `display_name` is not
-        facts = record["facts"]
-        ix = str(record["id"])
-        display = str(record["display_name"])
+        ix = sys.intern(str(record["id"]))
+        display = sys.intern(str(record["display_name"]))
         logging.info("Getting system facts for {}".format(ix))
 
-        # systems lacking data lack column, so you measuring such will be tough
-        if len(facts) == 0:
-            continue
-
-        # define some very high-level system facts
-        if not target_features:
-            target_features = ["system_properties.hostnames",
-                               "system_properties.memory_in_gb",
-                               "infrastructure.type",
-                               "infrastructure.vendor",
-                               "infrastructure.ipv4_addresses",
-                               "bios.vendor",
-                               "bios.version",
-                               "bios.release_date",
-                               "os.release",
-                               "os.kernel_release",
-                               "os.arch",
-                               "os.kernel_modules",
-                               "configuration.services"
-                               ]
-
         # data looks like this:
         # [{'facts': {'fqdn': '...'}, 'namespace': '...'}]
-
-        # iterate over all the elements in `facts`
-        for fact in facts:
+        for fact in record["facts"]:
             if not isinstance(fact, dict):
                 msg = "`facts` must dict, i.e. {'facts': {'fqdn': '...'}}"
                 raise IOError(msg)
 
             if "facts" not in fact:
                 raise KeyError("`facts` key must reside in the dictionary")
-            logging.info("{} fact(s) found".format(len(fact["facts"])))
-
-            # iterate over all the key-value pairs for each `facts` item
-            for k, v in fact["facts"].items():
-
-                # assert that system facts are in the explicit list
-                if k not in target_features:
-                    continue
-
-                logging.info("{} => {}".format(k, v))
-
-                # handling numeric values
-                if isinstance(v, (int, float, bool)):
-                    v = float(v)
-                    rows.append({"id": ix,
-                                 "display_name": display,
-                                 "value": v,
-                                 "col": k})
-
-                # if a collection, each collection item is its own feature
-                elif isinstance(v, (list, tuple)):
-                    for v_ in v:
-                        # some larger `v_` instances are collections; ignore
-                        if isinstance(v_, (dict, list)):
-                            continue
-                        rows.append({"id": ix,
-                                     "display_name": display,
-                                     "value": True,
-                                     "col": "{}|{}".format(k, v_)})
-
-                # handling strings is trivial
-                elif isinstance(v, str):
-                    rows.append({"id": ix,
-                                 "display_name": display,
-                                 "value": v,
-                                 "col": k})
-
-                # sometimes, values are `dict`, so handle accordingly
-                elif isinstance(v, dict):
-                    for k_, v_ in v.items():
-                        # some larger `v_` instances are collections; ignore
-                        if isinstance(v_, (dict, list)):
-                            continue
-                        rows.append({"id": ix,
-                                     "display_name": display,
-                                     "value": v_,
-                                     "col": k_})
-
-                # end-case; useful if key has column but its value is NaN / None
-                else:
-                    rows.append({"id": ix,
-                                 "display_name": display,
-                                 "value": -1,
-                                 "col": k})
-
-    # take all the newly-added data and make it into a DataFrame
-    frame = pd.DataFrame(rows)
+
+            # parallel lists; each system references one `id` and `display`
+            ids.extend([ix] * len(fact["facts"]))
+            displays.extend([display] * len(fact["facts"]))
+            cols.extend(fact["facts"].keys())
+            values.extend(fact["facts"].values())
+
+    # long-format, built column-wise; one row per key-value pair of `facts`
+    frame = pd.DataFrame({"id": ids,
+                          "display_name": displays,
+                          "col": cols,
+                          "value": values}, dtype=object)
+
+    # assert that system facts are in the explicit list
+    frame = frame[frame["col"].isin(target_features)]
+    value = frame["value"]
+
+    # masks follow `isinstance` precedence; the first matching kind wins
+    is_numeric = value.map(lambda v: isinstance(v, (int, float, bool)))
+    is_sequence = value.map(lambda v: isinstance(v, (list, tuple)))
+    is_string = value.map(lambda v: isinstance(v, str))
+    is_dict = value.map(lambda v: isinstance(v, dict))
+    is_numeric = is_numeric.astype(bool)
+    is_sequence = is_sequence.astype(bool) & ~is_numeric
+    is_string = is_string.astype(bool) & ~(is_numeric | is_sequence)
+    is_dict = is_dict.astype(bool) & ~(is_numeric | is_sequence | is_string)
+
+    # handling numeric values
+    numeric = frame[is_numeric]
+    numeric = numeric.assign(value=numeric["value"].astype(float))
+
+    # if a collection, each collection item is its own feature; names are made
+    # prior to exploding so that `None` items are not turned into NaN
+    sequences = frame[is_sequence]
+    names = [["{}|{}".format(k, v_) for v_ in v
+              if not isinstance(v_, (dict, list))]
+             for k, v in zip(sequences["col"], sequences["value"])]
+    sequences = sequences.assign(col=names, value=True).explode("col")
+    sequences = sequences[sequences["col"].notna()]
+
+    # handling strings is trivial
+    strings = frame[is_string]
+
+    # sometimes, values are `dict`, so handle accordingly
+    dicts = frame[is_dict]
+    dicts = dicts[dicts["value"].map(len) > 0]
+    item = dicts["value"].map(lambda v: list(v.items())).explode()
+    dicts = pd.DataFrame(item.tolist(),
+                         index=item.index,
+                         columns=["col", "value"],
+                         dtype=object).join(dicts[["id", "display_name"]])
+    nested = dicts["value"].map(lambda v: isinstance(v, (dict, list)))
+    dicts = dicts[~nested.astype(bool)]
+
+    # end-case; useful if key has column but its value is NaN / None
+    others = frame[~(is_numeric | is_sequence | is_string | is_dict)]
+    others = others.assign(value=-1)
+
+    # restore the original ordering so that `first` keeps its meaning
+    frame = pd.concat([numeric, sequences, strings, dicts, others])
+    frame = frame.sort_index(kind="stable")
     logging.info("# data-points parsed: {:,}".format(len(frame)))
 
     if len(frame) == 0:
         raise IOError("No data present. Ensure `dic` has valid data.")
 
-    # pivot the data and set `display_name` and `id` as its columns
-    frame = pd.pivot_table(frame,
-                           values="value",
-                           index=["id", "display_name"],
-                           columns="col",
-                           aggfunc="first")
+    # only the first non-null value per system and system fact is kept
+    frame = frame[frame["value"].notna()]
+
+    # integer row and column positions; both are sorted as a pivot would be
+    ids, id_uniques = pd.factorize(frame["id"], sort=True)
+    names, name_uniques = pd.factorize(frame["display_name"], sort=True)
+    rows, pairs = pd.factorize(ids * len(name_uniques) + names, sort=True)
+    cols, features = pd.factorize(frame["col"], sort=True)
+    systems = pd.MultiIndex.from_arrays(
+        [id_uniques.take(pairs // len(name_uniques)),
+         name_uniques.take(pairs % len(name_uniques))],
+        names=["id", "display_name"])
+
+    # duplicates share one integer (row, column) key; the first one is kept
+    first = ~pd.Series(rows * len(features) + cols).duplicated().values
+
+    # scatter each (row, column, value) triplet and set `id`, `display_name`
+    values = np.full((len(systems), len(features)), np.nan, dtype=object)
+    values[rows[first], cols[first]] = frame["value"].values[first]
+    frame = pd.DataFrame(values,
+                         index=systems,
+                         columns=pd.Index(features, name="col"),
+                         dtype=object)
     logging.info("Tabular shape: {:,} x {:,}".format(*frame.shape))
     return frame
 
@@ -270,7 +377,9 @@ def preprocess(frame, index=None, drop=None):
     """
     Performs important DataFrame pre-processing so that indices can be set,
     columns can be dropped, or non-numeric columns be encoded as their
-    equivalent numeric.
+    equivalent numeric. Numeric columns are narrowed to `float32` where their
+    range allows it, so downstream code must not rely on `float64` precision
+    or accumulation.
 
     Args:
         frame (DataFrame): pandas DataFrame.
@@ -295,19 +404,38 @@ def preprocess(frame, index=None, drop=None):
 
     # encode non-numeric columns as integer; datetimes are not `object`
     mappings = {}
+    encoded = {}
     for column in df.select_dtypes(include=(object, bool)):
 
-        # convert the non-numeric column as categorical and overwrite column
+        # encode the non-numeric column as integer codes
         logging.info("Mapping `{}` to integer".format(column))
-        category = df[column].astype("category")
-        df[column] = category.cat.codes.astype(float)
+        codes, cats = pd.factorize(df[column], sort=True)
+        encoded[column] = codes.astype(np.float32)
 
         # column categories and add mapping, i.e. "A" => 1, "B" => 2, etc.
-        cats = category.cat.categories
         mappings[column] = dict(zip(cats, range(len(cats))))
 
+    # overwrite all encoded columns as one block, keeping the column order
+    if encoded:
+        columns = df.columns
+        encoded = pd.DataFrame(encoded, index=df.index)
+        df = pd.concat((df.drop(encoded.columns, axis=1), encoded), axis=1)
+        df = df.reindex(columns=columns)
+
     # remove all remaining columns, i.e. `datetime`
     df = df.select_dtypes(include=np.number)
+
+    # narrow columns whose values fit; IF only ever compares `x < p`. Integers
+    # become `float32` only if exact, i.e. within 2 ** 24, since mixing them
+    # with `float32` columns would otherwise upcast the whole array to 64-bit
+    ints = df.select_dtypes(include=np.integer)
+    floats = df.select_dtypes(include="float64")
+    exact, float32 = 2 ** 24, np.finfo(np.float32)
+    narrow_ints = (ints.min() >= -exact) & (ints.max() <= exact)
+    narrow_floats = floats.abs().max() <= float32.max
+    dtypes = dict.fromkeys(ints.columns[narrow_ints], np.float32)
+    dtypes.update(dict.fromkeys(floats.columns[narrow_floats], np.float32))
+    df = df.astype(dtypes)
     logging.info("# columns encoded as integer: {}".format(len(mappings)))
 
     # return the DataFrame and categorical mappings
@@ -334,14 +462,15 @@ def preprocess_on(frame, on, min_records=50, index=None, drop=None):
     data, mapping = preprocess(frame, index, drop)
     out = []
 
-    # group-by `on` and return the chunks which satisfy minimum length
-    for _, chunk in data.groupby(on):
-        if len(chunk) > min_records:
+    # group-by `on` and return the chunks which satisfy minimum length; only
+    # row positions are grouped so that small chunks are never materialized
+    for positions in data.groupby(on).indices.values():
+        if len(positions) > min_records:
 
             # if only `on` is provided, set this as the index
             if index is None and on is not None:
                 index = on
-            out.append((chunk, mapping))
+            out.append((data.take(positions), mapping))
     return out
 
 
@@ -390,13 +519,16 @@ class IsolationForest:
             self.limit = int(np.ceil(np.log2(self.sample_size)))
             logging.info("New limit set to {}".format(self.limit))
 
+        # row-major copy made once so that sampled rows are contiguous in memory
+        values = np.ascontiguousarray(table.values)
+
         # train a tree around a subset of the data, hence ensemble
         for _ in range(self.num_trees):
 
             # select so-many rows
             logging.info("Sampling {} records".format(self.sample_size))
             ix = self.rng.choice(range(self.num_records), self.sample_size)
-            subset = table.values[ix]
+            subset = values[ix]
             self.trees.append(IsolationTree(subset, 0, self.limit, seed=seed))
             logging.info("{} trees built OK".format(len(self.trees)))
 
@@ -487,14 +619,17 @@ class IsolationForest:
         # for keeping track of anomaly scores
         out = []
 
+        # row-major layout so that each record is contiguous in memory
+        values = np.ascontiguousarray(data.values)
+
         # generate an anomaly score for each row in the dataset, array
-        for ix, row in data.iterrows():
+        for ix, row in zip(data.index, values):
             logging.info("Computing score for `{}` across trees".format(ix))
 
             # for each record, i, find out its depth in each tree, j
             depth = 0
             for j in range(self.num_trees):
-                depth += float(TreeScore(row.values, self.trees[j]).path)
+                depth += float(TreeScore(row, self.trees[j]).path)
             logging.info("Depth: {}".format(depth))
 
             # scale the depth by the total number of trees
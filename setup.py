@@ -13,8 +13,8 @@ setup(
                       "scipy",
                       "matplotlib",
                       "pandas",
-                      "pyarrow",
-                      "s3fs",
+                      "pyarrow>=10",
+                      "botocore",
                       "urllib3<1.25,>=1.20"],
     tests_require=['pytest',
                    'pytest-cov'],
@@ -1,7 +1,14 @@
+import os
+import shutil
 import logging
+import pyarrow
+import tempfile
 import unittest
 import numpy as np
 import pandas as pd
+from unittest import mock
+from collections import OrderedDict
+from pyarrow.fs import LocalFileSystem, SubTreeFileSystem
 from rad.rad import IsolationForest, IsolationTree, TreeScore
 
 from rad import rad
@@ -60,6 +67,235 @@ class TestS(unittest.TestCase):
         self.assertTrue(rad.s(x=x, n=n) <= .5)
 
 
+class TestFetchS3(unittest.TestCase):
+    """
+    Test behavior of `fetch_s3` given a local directory in lieu of S3; the
+    S3 filesystem and AWS credentials are stubbed.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.frame = pd.DataFrame({"a": np.arange(10), "b": list("ab") * 5})
+        os.makedirs(os.path.join(self.root, "bucket", "2021", "folder"))
+        self.frame.to_parquet(os.path.join(self.root, "bucket", "2021",
+                                           "folder", "part-0.parquet"))
+
+        # S3 paths, i.e. "bucket/...", resolve relative to the directory
+        fs = SubTreeFileSystem(self.root, LocalFileSystem())
+        patches = [mock.patch.object(rad, "S3FileSystem", return_value=fs),
+                   mock.patch.object(rad, "Session")]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_fetch_reads_all_records(self):
+        """
+        Test that all records in a folder of parquet files are read
+        """
+        frame = rad.fetch_s3("bucket", date="2021", folder="folder")
+        self.assertEqual(len(frame), len(self.frame))
+
+    def test_fetch_joins_path_parts(self):
+        """
+        Test that path parts are "/" joined regardless of stray slashes
+        """
+        frame = rad.fetch_s3("bucket/", date="/2021/", folder="folder/")
+        self.assertEqual(len(frame), len(self.frame))
+
+    def test_fetch_skips_empty_path_parts(self):
+        """
+        Test that an omitted date adds no empty part to the path
+        """
+        frame = rad.fetch_s3("bucket", folder="2021/folder")
+        self.assertEqual(len(frame), len(self.frame))
+
+    def test_fetch_single_file(self):
+        """
+        Test that a single `.parquet` file is read like its folder, i.e. no
+        partition columns are parsed from a `key=value` prefix
+        """
+        os.makedirs(os.path.join(self.root, "bucket", "dt=2021", "folder"))
+        self.frame.to_parquet(os.path.join(self.root, "bucket", "dt=2021",
+                                           "folder", "part-0.parquet"))
+        frame = rad.fetch_s3("bucket", date="dt=2021",
+                             folder="folder/part-0.parquet")
+        folder = rad.fetch_s3("bucket", date="dt=2021", folder="folder")
+        self.assertEqual(len(frame), len(self.frame))
+        self.assertListEqual(list(frame.columns), list(folder.columns))
+
+    def test_fetch_spark_folder(self):
+        """
+        Test that a Spark-style folder, named `*.parquet`, is read as a folder
+        """
+        os.makedirs(os.path.join(self.root, "bucket", "out.parquet"))
+        self.frame.to_parquet(os.path.join(self.root, "bucket", "out.parquet",
+                                           "part-0000.parquet"))
+        frame = rad.fetch_s3("bucket", folder="out.parquet")
+        self.assertEqual(len(frame), len(self.frame))
+
+    def test_fetch_columns(self):
+        """
+        Test that only the requested columns are read
+        """
+        frame = rad.fetch_s3("bucket", date="2021", folder="folder",
+                             columns=["b"])
+        self.assertListEqual(list(frame.columns), ["b"])
+
+    def test_fetch_columns_keeps_index(self):
+        """
+        Test that a stored, named index is kept when columns are selected
+        """
+        frame = self.frame.set_index(pd.Index(list("uvwxyzabcd"), name="key"))
+        os.makedirs(os.path.join(self.root, "bucket", "indexed"))
+        for i, part in enumerate((frame.iloc[:5], frame.iloc[5:])):
+            part.to_parquet(os.path.join(self.root, "bucket", "indexed",
+                                         "part-{}.parquet".format(i)))
+        out = rad.fetch_s3("bucket", folder="indexed", columns=["b"])
+        self.assertListEqual(list(out.columns), ["b"])
+        self.assertListEqual(sorted(out.index), sorted(frame.index))
+        self.assertEqual(out.index.name, "key")
+
+    def test_fetch_filters(self):
+        """
+        Test that DNF filters select only the matching records
+        """
+        frame = rad.fetch_s3("bucket", date="2021", folder="folder",
+                             filters=[("b", "=", "a")])
+        self.assertEqual(len(frame), 5)
+        self.assertTrue((frame["b"] == "a").all())
+
+    def test_io_thread_count_is_restored(self):
+        """
+        Test that the process-wide Arrow I/O thread-pool size is not changed
+        """
+        before = pyarrow.io_thread_count()
+        rad.fetch_s3("bucket", date="2021", folder="folder", workers=2)
+        self.assertEqual(pyarrow.io_thread_count(), before)
+
+    def test_concurrent_io_thread_count_is_not_shrunk(self):
+        """
+        Test that an overlapping scan neither shrinks the I/O thread-pool of
+        another, nor leaves it resized once both have finished
+        """
+        before = pyarrow.io_thread_count()
+        with rad._thread_pools(before + 8):
+            with rad._thread_pools(2):
+                self.assertEqual(pyarrow.io_thread_count(), before + 8)
+            self.assertEqual(pyarrow.io_thread_count(), before + 8)
+        self.assertEqual(pyarrow.io_thread_count(), before)
+
+    def test_concurrent_cpu_count_is_not_shrunk(self):
+        """
+        Test that an overlapping scan neither shrinks the CPU thread-pool of
+        another, nor leaves it resized once both have finished
+        """
+        before = pyarrow.cpu_count()
+        with rad._thread_pools(2, cpu_threads=before + 8):
+            with rad._thread_pools(2, cpu_threads=2):
+                self.assertEqual(pyarrow.cpu_count(), before + 8)
+            self.assertEqual(pyarrow.cpu_count(), before + 8)
+        self.assertEqual(pyarrow.cpu_count(), before)
+
+    def test_cpu_count_is_restored(self):
+        """
+        Test that the process-wide Arrow CPU thread-pool size is not changed
+        """
+        before = pyarrow.cpu_count()
+        rad.fetch_s3("bucket", date="2021", folder="folder", workers=2)
+        self.assertEqual(pyarrow.cpu_count(), before)
+
+
+class TestInventoryDataToPandas(unittest.TestCase):
+
+    def setUp(self):
+        facts = {"os.arch": "x86_64",
+                 "system_properties.memory_in_gb": 16,
+                 "configuration.services": ["sshd", "crond"],
+                 "bios.vendor": {"name": "acme"},
+                 "bios.version": None,
+                 "not.a.target": "spurious"}
+        self.data = {"results": [{"id": 1,
+                                  "display_name": "host",
+                                  "account": "000001",
+                                  "facts": [{"namespace": "insights",
+                                             "facts": facts}]}]}
+
+    def test_one_row_per_system(self):
+        """
+        Test that each system with facts is modeled as a single row
+        """
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertEqual(len(frame), 1)
+
+    def test_collection_items_are_own_feature(self):
+        """
+        Test that each item of a collection is expanded into its own column
+        """
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertIn("configuration.services|sshd", frame.columns)
+        self.assertIn("configuration.services|crond", frame.columns)
+
+    def test_dict_and_null_values_are_handled(self):
+        """
+        Test that `dict` values are expanded and null values are set to -1
+        """
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertEqual(frame["name"].iloc[0], "acme")
+        self.assertEqual(frame["bios.version"].iloc[0], -1)
+
+    def test_null_collection_item_is_own_feature(self):
+        """
+        Test that a `None` collection item is named as such, rather than NaN
+        """
+        facts = self.data["results"][0]["facts"][0]["facts"]
+        facts["infrastructure.ipv4_addresses"] = [None, "10.0.0.1"]
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertIn("infrastructure.ipv4_addresses|None", frame.columns)
+        self.assertNotIn("infrastructure.ipv4_addresses|nan", frame.columns)
+
+    def test_subclassed_values_are_handled(self):
+        """
+        Test that subclasses of numeric and `dict` values are not set to -1
+        """
+        facts = self.data["results"][0]["facts"][0]["facts"]
+        facts["system_properties.memory_in_gb"] = np.float64(16)
+        facts["bios.vendor"] = OrderedDict(name="acme")
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertEqual(frame["system_properties.memory_in_gb"].iloc[0], 16)
+        self.assertEqual(frame["name"].iloc[0], "acme")
+
+    def test_columns_are_object_dtype(self):
+        """
+        Test that all-string system facts are not inferred as a string dtype
+        """
+        frame = rad.inventory_data_to_pandas(self.data, ["os.arch"])
+        self.assertEqual(frame["os.arch"].dtype, object)
+
+    def test_non_target_features_are_ignored(self):
+        """
+        Test that system facts outside of `target_features` are not extracted
+        """
+        frame = rad.inventory_data_to_pandas(self.data)
+        self.assertNotIn("not.a.target", frame.columns)
+
+    def test_missing_account_raises_ioerror(self):
+        """
+        Test that records lacking the `account` key raise IOError
+        """
+        del self.data["results"][0]["account"]
+        self.assertRaises(IOError, rad.inventory_data_to_pandas, self.data)
+
+    def test_no_facts_raises_ioerror(self):
+        """
+        Test that if no system has facts, an IOError is raised
+        """
+        self.data["results"][0]["facts"] = []
+        self.assertRaises(IOError, rad.inventory_data_to_pandas, self.data)
+
+
 class TestPreprocess(unittest.TestCase):
 
     def setUp(self):
@@ -72,6 +308,20 @@ class TestPreprocess(unittest.TestCase):
         # numeric arrays, after `preprocess`, are exactly the same as before.
         self.assertEqual(frame.values.all(), self.frame.values.all())
 
+    def test_numeric_columns_narrowed_only_if_they_fit(self):
+        """
+        Test that columns become `float32` unless values exceed the range
+        """
+        frame = pd.DataFrame({"small": [1, 2],
+                              "large": [2 ** 24 + 1, 1],
+                              "real": [.5, 1.5],
+                              "huge": [np.finfo(float).max, 1.]})
+        frame, _ = rad.preprocess(frame)
+        self.assertEqual(frame["small"].dtype, np.float32)
+        self.assertEqual(frame["large"].dtype, np.int64)
+        self.assertEqual(frame["real"].dtype, np.float32)
+        self.assertEqual(frame["huge"].dtype, np.float64)
+
     def test_empty_mapping_given_numeric_array(self):
         """
         Test that if a numeric array is given, no mappings are returned.
@@ -145,6 +395,16 @@ class TestIsolationForest(unittest.TestCase):
         """
         self.assertEqual(self.forest.num_trees, len(self.forest.trees))
 
+    def test_trees_receive_float32(self):
+        """
+        Test that mixed integer and encoded columns reach trees as `float32`
+        """
+        frame = pd.DataFrame({"a": np.arange(40),
+                              "b": np.random.choice(["x", "y"], 40),
+                              "c": np.random.rand(40)})
+        forest = IsolationForest(frame, num_trees=2)
+        self.assertEqual(forest.trees[0].data.dtype, np.float32)
+
     def test_predict_length_equals_input_length(self):
         """
         Test that each input record has a corresponding prediction